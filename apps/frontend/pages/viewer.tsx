@@ -555,13 +555,21 @@ export default function ViewerPage() {
 					await ensureServerSocket();
 					if (!isServerBusyRef.current && serverWsRef.current && serverWsRef.current.readyState === WebSocket.OPEN) {
 						isServerBusyRef.current = true;
-						const dataUrl = canvas.toDataURL('image/jpeg', 0.6);
 						const meta = latestMetadataRef.current;
-						serverWsRef.current.send(JSON.stringify({
-							frame_id: meta?.frame_id ?? -1,
-							capture_ts: meta?.capture_ts ?? performance.now(),
-							image_b64: dataUrl
-						}));
+						const frameId = meta?.frame_id ?? -1;
+						const captureTs = meta?.capture_ts ?? performance.now();
+						// Binary frame: int32 frame_id + float64 capture_ts (LE) followed by raw JPEG, no base64
+						canvas.toBlob(async (blob) => {
+							const sock = serverWsRef.current;
+							if (!blob || !sock || sock.readyState !== WebSocket.OPEN) { isServerBusyRef.current = false; return; }
+							const jpeg = new Uint8Array(await blob.arrayBuffer());
+							const frame = new Uint8Array(12 + jpeg.length);
+							const header = new DataView(frame.buffer);
+							header.setInt32(0, frameId, true);
+							header.setFloat64(4, captureTs, true);
+							frame.set(jpeg, 12);
+							sock.send(frame);
+						}, 'image/jpeg', 0.6);
 					}
 				}
 			} finally {
@@ -1,17 +1,32 @@
+import asyncio
 import base64
-import io
+import copy
+import hashlib
+import json
+import logging
 import os
+import struct
+import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Dict, List
 
+import cv2
 import numpy as np
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.responses import JSONResponse
-from PIL import Image
 import onnxruntime as ort
+from turbojpeg import TJPF_RGB, TurboJPEG
+
+try:
+    from postprocess import decode_and_filter, fast_nms_numba
+except ImportError:
+    # numba not installed; postprocess_yolov8 falls back to the NumPy decode/NMS
+    decode_and_filter = fast_nms_numba = None
 
 
 app = FastAPI(title="webrtc-vlm inference server", version="0.1.0")
+LOGGER = logging.getLogger("uvicorn.error")
 
 
 # ------------------------------- Model Loading -------------------------------
@@ -22,215 +37,681 @@ def resolve_model_path() -> str:
     default_path = os.path.abspath(
         os.path.join(os.path.dirname(__file__), "..", "frontend", "public", "models", "model.onnx")
     )
-    return os.environ.get("MODEL_PATH", default_path)
+    model_path = os.environ.get("MODEL_PATH", default_path)
+    # Prefer derived builds sitting next to the FP32 model: INT8 (tools/quantize.py)
+    # and in-graph normalization (tools/bake_preprocess.py), unless model.onnx was replaced since
+    if os.path.basename(model_path) == "model.onnx":
+        for name in ("model.int8.preproc.onnx", "model.int8.onnx", "model.preproc.onnx"):
+            candidate = os.path.join(os.path.dirname(model_path), name)
+            if not os.path.exists(candidate):
+                continue
+            if _is_fresh(candidate, model_path):
+                return candidate
+            LOGGER.warning("ignoring %s: older than %s, rebuild it with tools/", candidate, model_path)
+    return model_path
+
+
+def _is_fresh(path: str, source: str) -> bool:
+    return os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(source)
 
 
 MODEL_PATH = resolve_model_path()
+# Derived graphs (.chw.onnx, .opt.onnx) live here rather than next to the model, which
+# by default sits in the frontend's publicly served folder
+MODEL_CACHE_DIR = os.environ.get("MODEL_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache"))
 SESSION: ort.InferenceSession | None = None
+_IN_NAME: str = ""
+_OUT_NAMES: List[str] = []
+_OUT_SHAPES: List[tuple] = []
+_BINDINGS: Dict[int, tuple[ort.IOBinding, List[np.ndarray]]] = {}
+_NEED_SIGMOID: bool | None = None  # whether class scores are logits, probed at load time
 MODEL_INPUT_SIZE = 320  # square input
+MAX_BATCH = int(os.environ.get("MAX_BATCH", "8"))
+BATCH_WAIT_MS = float(os.environ.get("BATCH_WAIT_MS", "5"))
+MAX_FRAME_AGE_MS = float(os.environ.get("MAX_FRAME_AGE_MS", "150"))
+FRAME_HASH_DISTANCE = int(os.environ.get("FRAME_HASH_DISTANCE", "2"))  # < 0 disables reuse
+FRAMES_DROPPED = 0
+
+# Preallocated letterbox canvas (HWC uint8) and batched model input (NCHW float32), reused every frame
+_CANVAS = np.zeros((MODEL_INPUT_SIZE, MODEL_INPUT_SIZE, 3), dtype=np.uint8)
+_INPUT_BUF = np.zeros((MAX_BATCH, 3, MODEL_INPUT_SIZE, MODEL_INPUT_SIZE), dtype=np.float32)
 
 
 def load_session() -> None:
     global SESSION
     if SESSION is not None:
         return
-    providers = ["CPUExecutionProvider"]
+    # [1,8400,84] exports get a Transpose grafted onto the output once (cached as
+    # <model>.chw.onnx in MODEL_CACHE_DIR) so decode always reads a contiguous [84, 8400] tensor
+    model_path = MODEL_PATH
+    chw_path = _cache_path(MODEL_PATH, ".chw.onnx")
+    if os.path.exists(chw_path):
+        model_path = chw_path
+    SESSION = _create_session(model_path)
+    if model_path == MODEL_PATH and _is_channels_last(SESSION.get_outputs()[0].shape):
+        try:
+            transpose_output(MODEL_PATH, chw_path)
+            SESSION = _create_session(chw_path)
+        except OSError:
+            pass  # read-only cache dir; _channels_first transposes per frame instead
+    bind_io()
+
+
+def _create_session(model_path: str) -> ort.InferenceSession:
+    providers = [p for p in ("DnnlExecutionProvider", "CPUExecutionProvider") if p in ort.get_available_providers()]
+    # Reuse an offline-optimized copy of the graph built from this exact source model.
+    # Only for the plain CPU provider: other providers compile subgraphs that ORT cannot serialize
+    if providers == ["CPUExecutionProvider"]:
+        opt_path = _cache_path(model_path, ".opt.onnx")
+        if not os.path.exists(opt_path):
+            try:
+                _write_optimized(model_path, opt_path)
+            except Exception as exc:
+                LOGGER.warning("could not cache optimized graph for %s: %s", model_path, exc)
+        if os.path.exists(opt_path):
+            model_path = opt_path
+    return ort.InferenceSession(model_path, sess_options=_session_options(), providers=providers)
+
+
+def _session_options() -> ort.SessionOptions:
+    so = ort.SessionOptions()
+    so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    so.intra_op_num_threads = int(os.environ.get("INTRA_OP_THREADS", os.cpu_count() or 4))
+    so.inter_op_num_threads = 1
+    so.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    so.add_session_config_entry("session.intra_op.allow_spinning", "1")
+    so.add_session_config_entry("session.qdqisint8allowed", "1")
+    so.enable_cpu_mem_arena = True
+    so.enable_mem_pattern = True
+    return so
+
+
+def _write_optimized(src: str, dst: str) -> None:
+    # Serialized at ENABLE_EXTENDED: the ENABLE_ALL layout transforms (NCHWc) are tied to
+    # the CPU that ran them, so they are redone in-session on every host instead
     so = ort.SessionOptions()
     so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
-    SESSION = ort.InferenceSession(MODEL_PATH, sess_options=so, providers=providers)
+    so.add_session_config_entry("session.qdqisint8allowed", "1")
+    # Written under a per-process name and renamed, so concurrent workers never
+    # load a half-written file
+    so.optimized_model_filepath = f"{dst}.{os.getpid()}.tmp"
+    ort.InferenceSession(src, sess_options=so, providers=["CPUExecutionProvider"])
+    os.replace(so.optimized_model_filepath, dst)
+
+
+def _cache_path(model_path: str, suffix: str) -> str:
+    # Keyed on the source model's identity (absolute path, size, mtime) so different models
+    # sharing a file name, or a model replaced in place, never pick up each other's graphs
+    try:
+        os.makedirs(MODEL_CACHE_DIR, exist_ok=True)
+    except OSError:
+        pass  # read-only; callers fall back to the source model
+    st = os.stat(model_path)
+    key = hashlib.sha1(f"{os.path.abspath(model_path)}:{st.st_size}:{st.st_mtime_ns}".encode()).hexdigest()[:16]
+    return os.path.join(MODEL_CACHE_DIR, f"{os.path.basename(model_path)}.{key}{suffix}")
+
+
+def _is_channels_last(shape: List[Any]) -> bool:
+    # Declared output shape, e.g. ['batch', 8400, 84]; symbolic dims are strings
+    if len(shape) != 3 or not isinstance(shape[2], int):
+        return False
+    return not isinstance(shape[1], int) or shape[1] > shape[2]
+
+
+def transpose_output(src: str, dst: str) -> None:
+    import onnx
+    from onnx import helper
+
+    model = onnx.load(src)
+    out = model.graph.output[0]
+    names = {n for node in model.graph.node for n in (*node.input, *node.output)}
+    raw = out.name + "_nlc"
+    while raw in names:
+        raw += "_"
+    for node in model.graph.node:
+        node.output[:] = [raw if o == out.name else o for o in node.output]
+        node.input[:] = [raw if i == out.name else i for i in node.input]
+    model.graph.node.append(helper.make_node("Transpose", [raw], [out.name], perm=[0, 2, 1]))
+    dims = [copy.deepcopy(d) for d in out.type.tensor_type.shape.dim]
+    del out.type.tensor_type.shape.dim[:]
+    out.type.tensor_type.shape.dim.extend([dims[0], dims[2], dims[1]])
+    tmp = f"{dst}.{os.getpid()}.tmp"
+    onnx.save(model, tmp)
+    os.replace(tmp, dst)
+
+
+def bind_io() -> None:
+    # Cache names and output shapes once; each batch size gets its own IOBinding over
+    # the first n rows of _INPUT_BUF so frames run without feed dicts or output copies
+    global _IN_NAME, _OUT_NAMES, _OUT_SHAPES, _NEED_SIGMOID, _INPUT_BUF
+    _IN_NAME = SESSION.get_inputs()[0].name
+    if SESSION.get_inputs()[0].type == "tensor(uint8)":
+        _INPUT_BUF = np.zeros((MAX_BATCH, *_input_shape(MODEL_INPUT_SIZE, np.uint8)), dtype=np.uint8)
+    _OUT_NAMES = [o.name for o in SESSION.get_outputs()]
+    # One plain run to learn the concrete output shapes for this input size
+    probe = SESSION.run(_OUT_NAMES, {_IN_NAME: _INPUT_BUF[:1]})
+    _OUT_SHAPES = [o.shape[1:] for o in probe]
+    # Exports with sigmoid in-graph stay within [0, 1]; raw logits do not
+    x = _channels_first(probe[0])
+    _NEED_SIGMOID = None if x is None else bool(x[4:].max() > 1.0 or x[4:].min() < 0.0)
+    _BINDINGS.clear()
+    _binding(1)
+
+
+def _binding(n: int) -> tuple[ort.IOBinding, List[np.ndarray]]:
+    bound = _BINDINGS.get(n)
+    if bound is None:
+        io = SESSION.io_binding()
+        io.bind_cpu_input(_IN_NAME, _INPUT_BUF[:n])
+        outs = [np.empty((n, *shape), dtype=np.float32) for shape in _OUT_SHAPES]
+        for name, buf in zip(_OUT_NAMES, outs):
+            io.bind_ortvalue_output(name, ort.OrtValue.ortvalue_from_numpy(buf))
+        bound = _BINDINGS[n] = (io, outs)
+    return bound
+
+
+def run_inference(n: int = 1) -> Dict[str, np.ndarray]:
+    # Runs the first n rows of _INPUT_BUF; outputs land in preallocated buffers in place
+    io, outs = _binding(n)
+    SESSION.run_with_iobinding(io)
+    return dict(zip(_OUT_NAMES, outs))
+
+
+def warmup(iterations: int = 5) -> None:
+    # Push a black frame through the whole batch path so ORT's arena and kernels, OpenCV
+    # and the Numba kernels (compiled or loaded from cache) are hot before the first client
+    dummy = np.zeros((MODEL_INPUT_SIZE, MODEL_INPUT_SIZE, 3), dtype=np.uint8)
+    for _ in range(iterations):
+        run_batch([dummy])
 
 
 @app.on_event("startup")
-def _startup() -> None:
+async def _startup() -> None:
+    global _BATCH_QUEUE, _BATCH_TASK, _EXEC
     load_session()
+    t0 = time.perf_counter()
+    warmup()
+    LOGGER.info("warmup done in %.1f ms", (time.perf_counter() - t0) * 1000.0)
+    # CPU stages run here so the event loop keeps serving sockets; NumPy, ORT, OpenCV,
+    # TurboJPEG and the Numba kernels all release the GIL while they work
+    _EXEC = ThreadPoolExecutor(max_workers=os.cpu_count())
+    _BATCH_QUEUE = asyncio.Queue()
+    _BATCH_TASK = asyncio.create_task(_batch_worker())
 
 
 @app.get("/")
 def root() -> JSONResponse:
-    return JSONResponse({"ok": True, "model": os.path.basename(MODEL_PATH)})
+    return JSONResponse({"ok": True, "model": os.path.basename(MODEL_PATH), "frames_dropped": FRAMES_DROPPED})
 
 
 # ------------------------------ Image Utilities ------------------------------
 
-def decode_image_from_b64(data_url: str) -> Image.Image:
+try:
+    _TJ: TurboJPEG | None = TurboJPEG()
+except (OSError, RuntimeError):
+    # libturbojpeg shared library not installed; fall back to OpenCV's decoder
+    _TJ = None
+
+
+def decode_image_from_b64(data_url: str, target_size: int | None = None) -> np.ndarray:
     # Accept plain base64 or data URLs like data:image/jpeg;base64,....
-    if "," in data_url:
-        _, b64 = data_url.split(",", 1)
+    comma = data_url.find(",")
+    b64 = data_url[comma + 1:] if comma >= 0 else data_url
+    return decode_jpeg(base64.b64decode(b64, validate=False), target_size)
+
+
+def decode_jpeg(img_bytes: bytes, target_size: int | None = None) -> np.ndarray:
+    if _TJ is None:
+        return decode_cv2(img_bytes)
+    try:
+        scaling_factor = None
+        if target_size is not None:
+            # Let the IDCT downscale by 2 when the frame is far larger than the model input
+            width, height, _, _ = _TJ.decode_header(img_bytes)
+            if width >= 2 * target_size and height >= 2 * target_size:
+                scaling_factor = (1, 2)
+        return _TJ.decode(img_bytes, pixel_format=TJPF_RGB, scaling_factor=scaling_factor)  # HWC RGB uint8
+    except OSError:
+        # Not a JPEG (e.g. a PNG data URL on the image_b64 protocol); let OpenCV sniff the format
+        return decode_cv2(img_bytes)
+
+
+def decode_cv2(img_bytes: bytes) -> np.ndarray:
+    bgr = cv2.imdecode(np.frombuffer(img_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if bgr is None:
+        raise ValueError("could not decode image")
+    return cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+
+
+def dhash(img: np.ndarray) -> int:
+    # 64-bit difference hash: sign of horizontal gradients on a 9x8 grayscale thumbnail
+    small = cv2.resize(img, (9, 8), interpolation=cv2.INTER_AREA).mean(axis=2)
+    return int.from_bytes(np.packbits(small[:, 1:] > small[:, :-1]).tobytes(), "big")
+
+
+def load_frame(jpeg: memoryview | None, image_b64: str | None) -> tuple[np.ndarray, int]:
+    if jpeg is not None:
+        img = decode_jpeg(jpeg, MODEL_INPUT_SIZE)
     else:
-        b64 = data_url
-    img_bytes = base64.b64decode(b64)
-    img = Image.open(io.BytesIO(img_bytes)).convert("RGB")
-    return img
+        img = decode_image_from_b64(image_b64, MODEL_INPUT_SIZE)
+    # Reject frames that cannot be letterboxed here, before they join a shared batch
+    letterbox_geometry(img.shape[1], img.shape[0], MODEL_INPUT_SIZE)
+    return img, dhash(img)
 
 
-def preprocess_letterbox(img: Image.Image, model_size: int) -> tuple[np.ndarray, dict]:
-    # Resize with letterbox to square model_size preserving aspect
-    src_w, src_h = img.size
+def letterbox_geometry(src_w: int, src_h: int, model_size: int) -> tuple[int, int, int, int]:
+    # Size and offset of the aspect-preserving resize inside the square model input
     scale = min(model_size / src_w, model_size / src_h)
     draw_w = int(round(src_w * scale))
     draw_h = int(round(src_h * scale))
-    dx = (model_size - draw_w) // 2
-    dy = (model_size - draw_h) // 2
+    if draw_w < 1 or draw_h < 1:
+        raise ValueError(f"frame {src_w}x{src_h} is too narrow to letterbox to {model_size}")
+    return draw_w, draw_h, (model_size - draw_w) // 2, (model_size - draw_h) // 2
+
+
+def preprocess_letterbox(img: np.ndarray, model_size: int, out: np.ndarray | None = None) -> tuple[np.ndarray, dict]:
+    # Resize with letterbox to square model_size preserving aspect
+    src_h, src_w = img.shape[:2]
+    draw_w, draw_h, dx, dy = letterbox_geometry(src_w, src_h, model_size)
+
+    # out is a [1, ...] slot shaped like the model input, by default the first row of _INPUT_BUF
+    if out is None:
+        out = _INPUT_BUF[:1]
+        if model_size != MODEL_INPUT_SIZE:
+            out = np.zeros((1, *_input_shape(model_size, out.dtype)), dtype=out.dtype)
+
+    if out.dtype == np.uint8:
+        # Normalization is baked into the graph (tools/bake_preprocess.py): letterbox
+        # straight into the NHWC uint8 input and skip the float pass entirely
+        canvas = out[0]
+    else:
+        canvas = _CANVAS if model_size == MODEL_INPUT_SIZE else np.zeros((model_size, model_size, 3), dtype=np.uint8)
+    canvas.fill(0)
 
-    canvas = Image.new("RGB", (model_size, model_size), (0, 0, 0))
-    resized = img.resize((draw_w, draw_h))
-    canvas.paste(resized, (dx, dy))
+    # Resize straight into the canvas region
+    cv2.resize(img, (draw_w, draw_h), dst=canvas[dy:dy + draw_h, dx:dx + draw_w], interpolation=cv2.INTER_LINEAR)
+    if out.dtype != np.uint8:
+        # Scale to 0..1 and reorder HWC -> CHW in one pass
+        np.multiply(canvas.transpose(2, 0, 1), np.float32(1.0 / 255.0), out=out[0], dtype=np.float32)
+    return out, {"dx": dx, "dy": dy, "draw_w": draw_w, "draw_h": draw_h, "model": model_size, "src_w": src_w, "src_h": src_h}
 
-    arr = np.asarray(canvas).astype(np.float32) / 255.0  # HWC RGB 0..1
-    chw = np.transpose(arr, (2, 0, 1))  # CHW
-    nchw = np.expand_dims(chw, 0)  # NCHW
-    return nchw, {"dx": dx, "dy": dy, "draw_w": draw_w, "draw_h": draw_h, "model": model_size, "src_w": src_w, "src_h": src_h}
+
+def _input_shape(model_size: int, dtype: np.dtype) -> tuple[int, int, int]:
+    # uint8 models take NHWC frames as-is; float models take normalized NCHW
+    return (model_size, model_size, 3) if dtype == np.uint8 else (3, model_size, model_size)
 
 
 def sigmoid(x: np.ndarray) -> np.ndarray:
     return 1 / (1 + np.exp(-x))
 
 
-def decode_yolov8(outputs: Dict[str, Any], lb: dict, score_thresh: float = 0.20) -> List[dict]:
+def needs_sigmoid(scores: np.ndarray) -> bool:
+    # Known from the load-time probe; otherwise judge from this frame's value range
+    if _NEED_SIGMOID is not None:
+        return _NEED_SIGMOID
+    return bool(scores.max() > 1.0 or scores.min() < 0.0)
+
+
+def _channels_first(out: np.ndarray) -> np.ndarray | None:
+    # [1,84,8400] -> [84,8400] view; [1,8400,84] exports are transposed once
+    dims = out.shape
+    if len(dims) != 3 or (dims[1] < 6 and dims[2] < 6):
+        return None
+    return out[0] if dims[1] >= 6 and dims[2] > dims[1] else np.ascontiguousarray(out[0].T)
+
+
+# Detections travel as one structured array from decode to the socket; dicts are only
+# built at the JSON boundary (detections_to_json)
+DET_DTYPE = np.dtype([
+    ("label", np.int32),  # numeric id, viewer maps to label
+    ("score", np.float32),
+    ("xmin", np.float32),
+    ("ymin", np.float32),
+    ("xmax", np.float32),
+    ("ymax", np.float32),
+])
+_EMPTY_DETS = np.empty(0, dtype=DET_DTYPE)
+
+
+def detections_to_json(dets: np.ndarray) -> List[dict]:
+    # tolist() converts every field to a Python scalar in one C pass
+    return [dict(zip(DET_DTYPE.names, row)) for row in dets.tolist()]
+
+
+def decode_yolov8(outputs: Dict[str, Any], lb: dict, score_thresh: float = 0.20) -> np.ndarray:
     # Expect common YOLOv8 export: [1, 84, 8400]
-    name = list(outputs.keys())[0]
-    out = outputs[name]
-    data: np.ndarray = out if isinstance(out, np.ndarray) else out.numpy() if hasattr(out, "numpy") else out
-    if hasattr(out, "shape"):
-        dims = list(out.shape)
-    else:
-        dims = []
-    dets: List[dict] = []
-    # Handle [1,84,8400] or [1,8400,84]
-    if len(dims) == 3 and (dims[1] >= 6 or dims[2] >= 6):
-        if dims[1] >= 6 and dims[2] > dims[1]:
-            # [1,84,8400]
-            num_classes = dims[1] - 4
-            num_props = dims[2]
-            x = data.reshape(dims)[0]  # [84, 8400]
-        else:
-            # [1,8400,84] -> transpose to [84, 8400]
-            num_props = dims[1]
-            num_classes = dims[2] - 4
-            x = data.reshape(dims)[0].transpose(1, 0)
-
-        # x is [84, num_props]
-        boxes = x[0:4, :]  # cx,cy,w,h
-        scores = x[4:4 + num_classes, :]
-        # Apply sigmoid if values look unbounded
-        if scores.max() > 1.0 or scores.min() < 0.0:
-            scores = sigmoid(scores)
-        best_cls = np.argmax(scores, axis=0)
-        best_score = scores[best_cls, np.arange(num_props)]
-
-        cx = boxes[0, :]
-        cy = boxes[1, :]
-        w = boxes[2, :]
-        h = boxes[3, :]
-
-        dx, dy, draw_w, draw_h = lb["dx"], lb["dy"], lb["draw_w"], lb["draw_h"]
-        src_w, src_h = lb["src_w"], lb["src_h"]
-
-        x1 = (cx - w / 2.0 - dx) / draw_w * src_w
-        y1 = (cy - h / 2.0 - dy) / draw_h * src_h
-        x2 = (cx + w / 2.0 - dx) / draw_w * src_w
-        y2 = (cy + h / 2.0 - dy) / draw_h * src_h
-
-        for i in range(num_props):
-            s = float(best_score[i])
-            if s < score_thresh:
-                continue
-            nx1 = max(0.0, min(1.0, float(x1[i] / src_w)))
-            ny1 = max(0.0, min(1.0, float(y1[i] / src_h)))
-            nx2 = max(0.0, min(1.0, float(x2[i] / src_w)))
-            ny2 = max(0.0, min(1.0, float(y2[i] / src_h)))
-            if nx2 <= nx1 or ny2 <= ny1:
-                continue
-            dets.append({
-                "label": int(best_cls[i]),  # numeric id, viewer maps to label
-                "score": s,
-                "xmin": nx1,
-                "ymin": ny1,
-                "xmax": nx2,
-                "ymax": ny2,
-            })
+    out = next(iter(outputs.values()))
+    data: np.ndarray = out if isinstance(out, np.ndarray) else out.numpy() if hasattr(out, "numpy") else np.asarray(out)
+    # Handle [1,84,8400] or [1,8400,84]; the latter becomes one contiguous copy so the
+    # argmax below runs over unit-stride rows
+    x = _channels_first(data)
+    if x is None:
+        return _EMPTY_DETS
+    num_classes = x.shape[0] - 4
+
+    # x is [84, num_props]
+    boxes = x[0:4, :]  # cx,cy,w,h
+    scores = x[4:4 + num_classes, :]
+    # Score prefilter: a plain max reduction screens all proposals, and only the (typically
+    # few) survivors pay for argmax and box math. Sigmoid is monotonic, so logits are
+    # compared against logit(score_thresh) and only the survivors are activated
+    max_scores = scores.max(axis=0)
+    apply_sigmoid = needs_sigmoid(scores)
+    thresh = float(np.log(score_thresh / (1.0 - score_thresh))) if apply_sigmoid else score_thresh
+    idx = np.nonzero(max_scores >= thresh)[0]
+    if idx.size == 0:
+        return _EMPTY_DETS
+    best_cls = np.argmax(scores[:, idx], axis=0)
+    best_score = max_scores[idx]
+    cx, cy, w, h = boxes[:, idx]  # fancy-index gather: fresh arrays, safe to modify in place
+    if apply_sigmoid:
+        best_score = sigmoid(best_score)
+
+    dx, dy, draw_w, draw_h = lb["dx"], lb["dy"], lb["draw_w"], lb["draw_h"]
+
+    # Undo letterbox and normalize to 0..1 of the source frame, in place on the survivors
+    w *= 0.5
+    h *= 0.5
+    cx -= dx
+    cy -= dy
+    x1, x2 = cx - w, cx + w
+    y1, y2 = cy - h, cy + h
+    for coord, size in ((x1, draw_w), (x2, draw_w), (y1, draw_h), (y2, draw_h)):
+        coord /= size
+        np.clip(coord, 0.0, 1.0, out=coord)
+
+    valid = (x2 > x1) & (y2 > y1)
+    dets = np.empty(int(valid.sum()), dtype=DET_DTYPE)
+    dets["label"] = best_cls[valid]
+    dets["score"] = best_score[valid]
+    dets["xmin"] = x1[valid]
+    dets["ymin"] = y1[valid]
+    dets["xmax"] = x2[valid]
+    dets["ymax"] = y2[valid]
     return dets
 
 
-def nms(dets: List[dict], iou_thresh: float = 0.45, max_det: int = 50) -> List[dict]:
-    if not dets:
-        return []
-    dets = sorted(dets, key=lambda d: d["score"], reverse=True)
-    keep: List[dict] = []
-
-    def iou(a: dict, b: dict) -> float:
-        x1 = max(a["xmin"], b["xmin"]) ; y1 = max(a["ymin"], b["ymin"]) ; x2 = min(a["xmax"], b["xmax"]) ; y2 = min(a["ymax"], b["ymax"]) ;
-        inter = max(0.0, x2 - x1) * max(0.0, y2 - y1)
-        area_a = max(0.0, a["xmax"] - a["xmin"]) * max(0.0, a["ymax"] - a["ymin"]) ; area_b = max(0.0, b["xmax"] - b["xmin"]) * max(0.0, b["ymax"] - b["ymin"]) ;
-        union = area_a + area_b - inter
-        return 0.0 if union <= 0 else inter / union
-
-    for d in dets:
-        ok = True
-        for k in keep:
-            if iou(d, k) > iou_thresh:
-                ok = False
-                break
-        if ok:
-            keep.append(d)
-            if len(keep) >= max_det:
+def nms(dets: np.ndarray, iou_thresh: float = 0.45, max_det: int = 50, top_k: int = 300) -> np.ndarray:
+    # Fast-NMS: one IoU matrix over the score-sorted candidates, a box survives if no
+    # higher-scoring box of the same class overlaps it. Slightly more aggressive than greedy NMS.
+    if dets.size == 0:
+        return dets
+    dets = dets[np.argsort(-dets["score"], kind="stable")[:top_k]]
+    b = np.stack([dets["xmin"], dets["ymin"], dets["xmax"], dets["ymax"]], axis=1)
+    # Per-class NMS in a single pass: shift each class into its own disjoint region so
+    # boxes of different classes never overlap. Coordinates are normalized to 0..1,
+    # so a stride of 2 is enough and keeps float32 precision intact
+    b += dets["label"][:, None].astype(np.float32) * 2.0
+
+    areas = np.clip(b[:, 2] - b[:, 0], 0.0, None) * np.clip(b[:, 3] - b[:, 1], 0.0, None)
+    xx1 = np.maximum(b[:, None, 0], b[None, :, 0])
+    yy1 = np.maximum(b[:, None, 1], b[None, :, 1])
+    xx2 = np.minimum(b[:, None, 2], b[None, :, 2])
+    yy2 = np.minimum(b[:, None, 3], b[None, :, 3])
+    inter = np.clip(xx2 - xx1, 0.0, None) * np.clip(yy2 - yy1, 0.0, None)
+    iou = inter / (areas[:, None] + areas[None, :] - inter + 1e-9)
+
+    # Row i only suppresses columns j > i (lower-scoring boxes)
+    iou = np.triu(iou, k=1)
+    keep_idx = np.nonzero(iou.max(axis=0) <= iou_thresh)[0][:max_det]
+    return dets[keep_idx]
+
+
+_POST_BUFS: Dict[int, tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]] = {}
+
+
+def _post_buffers(num_props: int) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # Output buffers for the Numba kernels, allocated once per proposal count
+    bufs = _POST_BUFS.get(num_props)
+    if bufs is None:
+        bufs = (
+            np.empty((num_props, 4), dtype=np.float32),
+            np.empty(num_props, dtype=np.float32),
+            np.empty(num_props, dtype=np.int32),
+            np.empty(num_props, dtype=np.int64),
+        )
+        _POST_BUFS[num_props] = bufs
+    return bufs
+
+
+def postprocess_yolov8(outputs: Dict[str, Any], lb: dict, score_thresh: float = 0.25,
+                       iou_thresh: float = 0.45, max_det: int = 50, top_k: int = 300) -> np.ndarray:
+    if decode_and_filter is None:
+        return nms(decode_yolov8(outputs, lb, score_thresh), iou_thresh, max_det, top_k)
+
+    # Kernels expect [84, num_props]
+    x = _channels_first(np.asarray(next(iter(outputs.values())), dtype=np.float32))
+    if x is None:
+        return _EMPTY_DETS
+    num_classes = x.shape[0] - 4
+    apply_sigmoid = needs_sigmoid(x[4:])
+
+    boxes, det_scores, labels, keep = _post_buffers(x.shape[1])
+    n = decode_and_filter(x, num_classes, float(lb["dx"]), float(lb["dy"]), float(lb["draw_w"]), float(lb["draw_h"]),
+                          score_thresh, apply_sigmoid, boxes, det_scores, labels)
+    k = fast_nms_numba(boxes, det_scores, labels, n, iou_thresh, max_det, top_k, keep)
+    kept = keep[:k]
+    dets = np.empty(k, dtype=DET_DTYPE)
+    dets["label"] = labels[kept]
+    dets["score"] = det_scores[kept]
+    dets["xmin"] = boxes[kept, 0]
+    dets["ymin"] = boxes[kept, 1]
+    dets["xmax"] = boxes[kept, 2]
+    dets["ymax"] = boxes[kept, 3]
+    return dets
+
+
+# ------------------------------- Frame Framing -------------------------------
+
+# Binary frames: int32 frame_id + float64 capture_ts (little endian), then raw JPEG bytes
+FRAME_HEADER = struct.Struct("<id")
+
+
+def parse_binary_frame(data: bytes) -> tuple[dict, memoryview]:
+    if len(data) <= FRAME_HEADER.size:
+        raise ValueError("truncated frame")
+    frame_id, capture_ts = FRAME_HEADER.unpack_from(data)
+    return {"frame_id": frame_id, "capture_ts": capture_ts}, memoryview(data)[FRAME_HEADER.size:]
+
+
+# ------------------------------ Dynamic Batching -----------------------------
+
+_BATCH_QUEUE: "asyncio.Queue[tuple[np.ndarray, asyncio.Future]] | None" = None
+_BATCH_TASK: asyncio.Task | None = None
+_EXEC: ThreadPoolExecutor | None = None
+_CONNECTIONS = 0
+
+
+def run_batch(imgs: List[np.ndarray]) -> tuple[List[np.ndarray | Exception], float, float]:
+    # Letterbox every frame straight into the next free row of _INPUT_BUF, run once, split
+    # per frame. A frame that fails to letterbox gets its exception as its result and no row,
+    # so it cannot fail the other viewers' frames in the batch
+    results: List[np.ndarray | Exception] = []
+    rows = []  # (result index, letterbox info) per filled row
+    for i, img in enumerate(imgs):
+        k = len(rows)
+        try:
+            lb = preprocess_letterbox(img, MODEL_INPUT_SIZE, out=_INPUT_BUF[k:k + 1])[1]
+        except Exception as e:
+            results.append(e)
+            continue
+        results.append(_EMPTY_DETS)
+        rows.append((i, lb))
+    t0 = t1 = time.perf_counter() * 1000.0
+    if rows:
+        outputs = run_inference(len(rows))
+        t1 = time.perf_counter() * 1000.0
+        for k, (i, lb) in enumerate(rows):
+            results[i] = postprocess_yolov8(
+                {name: o[k:k + 1] for name, o in outputs.items()}, lb, score_thresh=0.25, iou_thresh=0.45, max_det=50
+            )
+    return results, t0, t1
+
+
+async def _batch_worker() -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        items = [await _BATCH_QUEUE.get()]
+        # Only hold the batch open when other connections could contribute frames
+        deadline = loop.time() + (BATCH_WAIT_MS / 1000.0 if _CONNECTIONS > 1 else 0.0)
+        while len(items) < MAX_BATCH:
+            remaining = deadline - loop.time()
+            try:
+                if remaining <= 0:
+                    items.append(_BATCH_QUEUE.get_nowait())
+                else:
+                    items.append(await asyncio.wait_for(_BATCH_QUEUE.get(), remaining))
+            except (asyncio.TimeoutError, asyncio.QueueEmpty):
                 break
-    return keep
+
+        try:
+            # Only one batch is in flight at a time, so the shared input/output buffers
+            # are never touched by two threads at once
+            dets, t0, t1 = await loop.run_in_executor(_EXEC, run_batch, [img for img, _ in items])
+        except Exception as e:
+            for _, fut in items:
+                if not fut.done():
+                    fut.set_exception(e)
+            continue
+        for (_, fut), d in zip(items, dets):
+            # The requesting socket may have gone away while the batch ran
+            if fut.done():
+                continue
+            if isinstance(d, Exception):
+                fut.set_exception(d)
+            else:
+                fut.set_result((d, t0, t1))
+
+
+async def infer(img: np.ndarray) -> tuple[np.ndarray, float, float]:
+    fut = asyncio.get_running_loop().create_future()
+    await _BATCH_QUEUE.put((img, fut))
+    return await fut
 
 
 # ----------------------------- WebSocket Endpoint ----------------------------
 
 @app.websocket("/detect")
 async def detect_ws(ws: WebSocket) -> None:
+    global _CONNECTIONS
     await ws.accept()
-    while True:
-        try:
-            msg = await ws.receive_json()
-        except WebSocketDisconnect:
-            break
-        except Exception:
-            # Ignore malformed frames
-            continue
+    _CONNECTIONS += 1
+    try:
+        await _serve_detect(ws)
+    finally:
+        _CONNECTIONS -= 1
+
+
+async def _read_frames(ws: WebSocket, frames: asyncio.Queue) -> None:
+    # Receive continuously so frames that arrive during inference are seen (and can be
+    # skipped) instead of piling up unread in the socket
+    try:
+        while True:
+            message = await ws.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            server_recv_ts = time.perf_counter() * 1000.0
+
+            # Binary frames carry raw JPEG after a fixed header; text frames are the
+            # original JSON {frame_id, capture_ts, image_b64} protocol
+            jpeg = None
+            try:
+                if message.get("bytes") is not None:
+                    msg, jpeg = parse_binary_frame(message["bytes"])
+                else:
+                    msg = json.loads(message["text"])
+            except Exception:
+                # Ignore malformed frames
+                continue
+            frames.put_nowait((msg, jpeg, server_recv_ts))
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
+        frames.put_nowait(None)
+
+
+async def _drop_frame(ws: WebSocket, msg: dict) -> None:
+    global FRAMES_DROPPED
+    FRAMES_DROPPED += 1
+    await ws.send_json({"frame_id": int(msg.get("frame_id", -1)), "dropped": True})
+
+
+async def _serve_detect(ws: WebSocket) -> None:
+    frames: asyncio.Queue = asyncio.Queue()
+    reader = asyncio.create_task(_read_frames(ws, frames))
+    # Detections of the last inferred frame, reused while the camera sees the same scene
+    last_hash: int | None = None
+    last_dets = _EMPTY_DETS
+    try:
+        while True:
+            item = await frames.get()
+            # Latest frame wins: anything queued behind a slow inference is already stale
+            while item is not None and not frames.empty():
+                await _drop_frame(ws, item[0])
+                item = frames.get_nowait()
+            if item is None:
+                break
+            msg, jpeg, server_recv_ts = item
 
-        frame_id = int(msg.get("frame_id", -1))
-        capture_ts = float(msg.get("capture_ts", 0))
-        image_b64 = msg.get("image_b64")
-        if not image_b64:
-            await ws.send_json({"error": "missing image_b64"})
-            continue
+            frame_id = int(msg.get("frame_id", -1))
+            capture_ts = float(msg.get("capture_ts", 0))
+            image_b64 = msg.get("image_b64")
+            if jpeg is None and not image_b64:
+                await ws.send_json({"error": "missing image_b64"})
+                continue
 
-        server_recv_ts = time.perf_counter() * 1000.0
+            # capture_ts comes from the sender's clock, so staleness is judged by how long
+            # the frame has waited on this server
+            if time.perf_counter() * 1000.0 - server_recv_ts > MAX_FRAME_AGE_MS:
+                await _drop_frame(ws, msg)
+                continue
 
-        try:
-            img = decode_image_from_b64(image_b64)
-            arr, lb = preprocess_letterbox(img, MODEL_INPUT_SIZE)
-
-            inputs: Dict[str, Any] = {SESSION.get_inputs()[0].name: arr}
-            t0 = time.perf_counter() * 1000.0
-            outputs_list = SESSION.run(None, inputs)
-            t1 = time.perf_counter() * 1000.0
-            outputs = {SESSION.get_outputs()[i].name: outputs_list[i] for i in range(len(outputs_list))}
-
-            dets = decode_yolov8(outputs, lb, score_thresh=0.25)
-            dets = nms(dets, iou_thresh=0.45, max_det=50)
-
-            await ws.send_json({
-                "frame_id": frame_id,
-                "capture_ts": capture_ts,
-                "recv_ts": server_recv_ts,
-                "server_recv_ts": server_recv_ts,
-                "inference_ts": t1,
-                "inference_ms": t1 - t0,
-                "detections": dets,
-            })
-        except Exception as e:
-            await ws.send_json({"frame_id": frame_id, "error": str(e)})
+            try:
+                img, frame_hash = await asyncio.get_running_loop().run_in_executor(_EXEC, load_frame, jpeg, image_b64)
+                cached = last_hash is not None and (frame_hash ^ last_hash).bit_count() <= FRAME_HASH_DISTANCE
+                if cached:
+                    dets = last_dets
+                    t0 = t1 = time.perf_counter() * 1000.0
+                else:
+                    dets, t0, t1 = await infer(img)
+                    last_hash, last_dets = frame_hash, dets
+
+                await ws.send_json({
+                    "frame_id": frame_id,
+                    "capture_ts": capture_ts,
+                    "recv_ts": server_recv_ts,
+                    "server_recv_ts": server_recv_ts,
+                    "inference_ts": t1,
+                    "inference_ms": t1 - t0,
+                    "detections": detections_to_json(dets),
+                    "cached": cached,
+                })
+            except Exception as e:
+                await ws.send_json({"frame_id": frame_id, "error": str(e)})
+    finally:
+        reader.cancel()
 
 
 if __name__ == "__main__":
     import uvicorn
 
     port = int(os.environ.get("PORT", "8000"))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    cpus = os.cpu_count() or 2
+    # One worker by default: a single session (one copy of the weights) whose intra-op
+    # pool spans every core, fed by the batch consumer. Scale out with more container
+    # replicas rather than more workers; WORKERS > 1 loads one session per process and
+    # splits the cores between them
+    workers = int(os.environ.get("WORKERS", "1"))
+    os.environ.setdefault("INTRA_OP_THREADS", str(max(1, cpus // workers)))
+    uvicorn.run(
+        "main:app",
+        app_dir=os.path.dirname(os.path.abspath(__file__)),
+        host="0.0.0.0",
+        port=port,
+        workers=workers,
+        loop="asyncio" if sys.platform == "win32" else "uvloop",  # uvloop has no Windows build
+        http="httptools",
+        ws="websockets",
+    )
 
 
@@ -0,0 +1,92 @@
+import math
+
+import numpy as np
+from numba import njit
+
+
+# ----------------------------- Numba Postprocess -----------------------------
+# Compiled decode + NMS for the [4 + num_classes, num_props] YOLOv8 head.
+# Results are written into caller-owned buffers; functions return the count.
+
+@njit(cache=True, fastmath=True, boundscheck=False, nogil=True)
+def decode_and_filter(x, num_classes, dx, dy, draw_w, draw_h, score_thresh, apply_sigmoid,
+                      out_boxes, out_scores, out_labels):
+    num_props = x.shape[1]
+    best = np.empty(num_props, dtype=np.float32)
+
+    # Class-major max screen: a branchless, contiguous inner loop that vectorizes cleanly.
+    # The argmax is only resolved for the proposals that pass the threshold below
+    for i in range(num_props):
+        best[i] = x[4, i]
+    for c in range(1, num_classes):
+        row = x[4 + c]
+        for i in range(num_props):
+            best[i] = max(best[i], row[i])
+
+    # Sigmoid is monotonic: compare logits against logit(score_thresh) and only
+    # activate the proposals that survive
+    raw_thresh = math.log(score_thresh / (1.0 - score_thresh)) if apply_sigmoid else score_thresh
+    n = 0
+    for i in range(num_props):
+        s = best[i]
+        if s < raw_thresh:
+            continue
+        # First class attaining the max, i.e. the argmax
+        cls = 0
+        for c in range(num_classes):
+            if x[4 + c, i] == s:
+                cls = c
+                break
+        if apply_sigmoid:
+            s = 1.0 / (1.0 + math.exp(-s))
+        cx = x[0, i]
+        cy = x[1, i]
+        hw = x[2, i] * 0.5
+        hh = x[3, i] * 0.5
+        x1 = min(max((cx - hw - dx) / draw_w, 0.0), 1.0)
+        y1 = min(max((cy - hh - dy) / draw_h, 0.0), 1.0)
+        x2 = min(max((cx + hw - dx) / draw_w, 0.0), 1.0)
+        y2 = min(max((cy + hh - dy) / draw_h, 0.0), 1.0)
+        if x2 <= x1 or y2 <= y1:
+            continue
+        out_boxes[n, 0] = x1
+        out_boxes[n, 1] = y1
+        out_boxes[n, 2] = x2
+        out_boxes[n, 3] = y2
+        out_scores[n] = s
+        out_labels[n] = cls
+        n += 1
+    return n
+
+
+@njit(cache=True, fastmath=True, boundscheck=False, nogil=True)
+def fast_nms_numba(boxes, scores, labels, n, iou_thresh, max_det, top_k, keep):
+    # Per-class Fast-NMS over the first n rows: a box survives unless some higher-scoring
+    # candidate of the same class (suppressed or not) overlaps it by more than iou_thresh.
+    order = np.argsort(-scores[:n])[:top_k]
+    m = order.shape[0]
+    k = 0
+    for j in range(m):
+        bj = order[j]
+        area_j = (boxes[bj, 2] - boxes[bj, 0]) * (boxes[bj, 3] - boxes[bj, 1])
+        suppressed = False
+        for i in range(j):
+            bi = order[i]
+            # Same effect as the coordinate-offset trick, without touching the boxes
+            if labels[bi] != labels[bj]:
+                continue
+            iw = min(boxes[bi, 2], boxes[bj, 2]) - max(boxes[bi, 0], boxes[bj, 0])
+            ih = min(boxes[bi, 3], boxes[bj, 3]) - max(boxes[bi, 1], boxes[bj, 1])
+            if iw <= 0.0 or ih <= 0.0:
+                continue
+            inter = iw * ih
+            area_i = (boxes[bi, 2] - boxes[bi, 0]) * (boxes[bi, 3] - boxes[bi, 1])
+            if inter / (area_i + area_j - inter + 1e-9) > iou_thresh:
+                suppressed = True
+                break
+        if not suppressed:
+            keep[k] = bj
+            k += 1
+            if k >= max_det:
+                break
+    return k
@@ -0,0 +1,78 @@
+"""Fold input normalization into the detection model.
+
+Usage:
+    python tools/bake_preprocess.py [--model model.onnx] [--out model.preproc.onnx]
+
+Prepends Transpose(NHWC -> NCHW) -> Cast(float) -> Mul(1/255) to the graph so it
+takes the letterboxed uint8 RGB frame as-is ([N, H, W, 3]). The server picks up
+model.preproc.onnx (or model.int8.preproc.onnx) automatically when it sits next to
+model.onnx and then skips normalization on the Python side.
+"""
+import argparse
+import copy
+import os
+
+import numpy as np
+import onnx
+from onnx import TensorProto, helper, numpy_helper
+
+
+def bake(src: str, dst: str) -> None:
+    model = onnx.load(src)
+    graph = model.graph
+    inp = graph.input[0]
+    if inp.type.tensor_type.elem_type == TensorProto.UINT8:
+        raise SystemExit(f"{src} already takes uint8 input")
+
+    name = inp.name
+    # Quantized graphs already use names like images_scale, so suffix until unused
+    taken = {n for node in graph.node for n in (*node.input, *node.output)}
+    taken.update(t.name for t in (*graph.initializer, *graph.value_info, *graph.input, *graph.output))
+    nchw, as_float, scale, normalized = (_unique(name + suffix, taken) for suffix in ("_nchw", "_float", "_scale", "_normalized"))
+    for node in graph.node:
+        node.input[:] = [normalized if i == name else i for i in node.input]
+
+    # [N, 3, H, W] float -> [N, H, W, 3] uint8, keeping the original (possibly symbolic) dims
+    n, c, h, w = (copy.deepcopy(d) for d in inp.type.tensor_type.shape.dim)
+    inp.type.tensor_type.elem_type = TensorProto.UINT8
+    del inp.type.tensor_type.shape.dim[:]
+    inp.type.tensor_type.shape.dim.extend([n, h, w, c])
+
+    graph.initializer.append(numpy_helper.from_array(np.array(1.0 / 255.0, dtype=np.float32), scale))
+    prologue = [
+        # Transpose while still uint8: a quarter of the bytes of a float transpose
+        helper.make_node("Transpose", [name], [nchw], perm=[0, 3, 1, 2]),
+        helper.make_node("Cast", [nchw], [as_float], to=TensorProto.FLOAT),
+        helper.make_node("Mul", [as_float, scale], [normalized]),
+    ]
+    nodes = prologue + list(graph.node)
+    del graph.node[:]
+    graph.node.extend(nodes)
+
+    onnx.checker.check_model(model)
+    onnx.save(model, dst)
+
+
+def _unique(name: str, taken: set) -> str:
+    while name in taken:
+        name += "_"
+    taken.add(name)
+    return name
+
+
+def main() -> None:
+    default_model = os.path.abspath(
+        os.path.join(os.path.dirname(__file__), "..", "..", "frontend", "public", "models", "model.onnx")
+    )
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--model", default=os.environ.get("MODEL_PATH", default_model))
+    ap.add_argument("--out", default=None, help="defaults to <model>.preproc.onnx")
+    args = ap.parse_args()
+
+    out_path = args.out or os.path.splitext(args.model)[0] + ".preproc.onnx"
+    bake(args.model, out_path)
+    print(f"wrote {out_path}")
+
+
+if __name__ == "__main__":
+    main()
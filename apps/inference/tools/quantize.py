@@ -0,0 +1,96 @@
+"""Produce an INT8 (QDQ, per-channel) copy of the detection model.
+
+Usage:
+    python tools/quantize.py --images path/to/frames [--model model.onnx] [--out model.int8.onnx]
+
+Calibration uses up to --count images from --images, letterboxed exactly like
+the server does. The server picks up model.int8.onnx automatically when it sits
+next to model.onnx.
+"""
+import argparse
+import glob
+import os
+import tempfile
+
+import cv2
+import numpy as np
+import onnx
+from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+from onnxruntime.quantization.shape_inference import quant_pre_process
+
+
+MODEL_INPUT_SIZE = 320
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".bmp")
+
+
+def letterbox(path: str, model_size: int) -> np.ndarray:
+    bgr = cv2.imread(path, cv2.IMREAD_COLOR)
+    if bgr is None:
+        raise ValueError(f"could not read {path}")
+    rgb = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+    src_h, src_w = rgb.shape[:2]
+    scale = min(model_size / src_w, model_size / src_h)
+    draw_w = int(round(src_w * scale))
+    draw_h = int(round(src_h * scale))
+    dx = (model_size - draw_w) // 2
+    dy = (model_size - draw_h) // 2
+    canvas = np.zeros((model_size, model_size, 3), dtype=np.uint8)
+    cv2.resize(rgb, (draw_w, draw_h), dst=canvas[dy:dy + draw_h, dx:dx + draw_w], interpolation=cv2.INTER_LINEAR)
+    return (canvas.transpose(2, 0, 1)[None].astype(np.float32) / 255.0)
+
+
+class FrameReader(CalibrationDataReader):
+    def __init__(self, input_name: str, paths: list[str], model_size: int):
+        self.input_name = input_name
+        self.paths = iter(paths)
+        self.model_size = model_size
+
+    def get_next(self) -> dict | None:
+        path = next(self.paths, None)
+        if path is None:
+            return None
+        return {self.input_name: letterbox(path, self.model_size)}
+
+
+def main() -> None:
+    default_model = os.path.abspath(
+        os.path.join(os.path.dirname(__file__), "..", "..", "frontend", "public", "models", "model.onnx")
+    )
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--images", required=True, help="directory of calibration frames")
+    ap.add_argument("--model", default=os.environ.get("MODEL_PATH", default_model))
+    ap.add_argument("--out", default=None, help="defaults to <model dir>/model.int8.onnx")
+    ap.add_argument("--count", type=int, default=100)
+    args = ap.parse_args()
+
+    paths = sorted(p for p in glob.glob(os.path.join(args.images, "*")) if p.lower().endswith(IMAGE_EXTS))[:args.count]
+    if not paths:
+        raise SystemExit(f"no images found in {args.images}")
+    out_path = args.out or os.path.join(os.path.dirname(args.model), "model.int8.onnx")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Per-channel QDQ needs opset >= 13; the bundled YOLOv8 export is opset 11
+        model = onnx.load(args.model)
+        src = args.model
+        if max(o.version for o in model.opset_import if o.domain in ("", "ai.onnx")) < 13:
+            src = os.path.join(tmp, "model.opset13.onnx")
+            onnx.save(onnx.version_converter.convert_version(model, 13), src)
+
+        # Shape inference + graph cleanup as recommended before static quantization
+        prepped = os.path.join(tmp, "model.prep.onnx")
+        quant_pre_process(src, prepped, skip_symbolic_shape=True)
+        input_name = onnx.load(prepped).graph.input[0].name
+        quantize_static(
+            prepped,
+            out_path,
+            FrameReader(input_name, paths, MODEL_INPUT_SIZE),
+            quant_format=QuantFormat.QDQ,
+            per_channel=True,
+            activation_type=QuantType.QInt8,
+            weight_type=QuantType.QInt8,
+        )
+    print(f"wrote {out_path} (calibrated on {len(paths)} frames)")
+
+
+if __name__ == "__main__":
+    main()